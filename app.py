@@ -4,39 +4,116 @@
 # 2. Secure password hashing for storage and verification.
 # 3. Updated database schema and registration to include passwords.
 
+import functools
 import os
+import queue
 import shutil
 import sqlite3
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from flask import Flask, render_template, request, url_for, g, jsonify, redirect, send_from_directory, make_response
 from flask_socketio import SocketIO
-from werkzeug.security import generate_password_hash, check_password_hash
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
+from werkzeug.security import check_password_hash
 from werkzeug.utils import secure_filename
 
 DATABASE = 'users.db'
+DB_POOL_SIZE = 8
 USER_FILES_DIR = 'user_files'
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 64 * 1024 # KiB
+ARGON2_PARALLELISM = 2
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-very-secret-key!'
 app.config['USER_FILES_DIR'] = USER_FILES_DIR
-socketio = SocketIO(app)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+# Hand file bodies to the front-end server (Apache mod_xsendfile or similar)
+# when deployed behind one; the dev server has to stream them itself.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+socketio = SocketIO(app, async_mode='threading')
+
+# Password hashing is deliberately slow, so it runs in worker processes
+# instead of holding the GIL on the request thread.
+HASH_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+PH = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST,
+                    parallelism=ARGON2_PARALLELISM, hash_len=32)
+
+# --- Password Functions ---
+
+def hash_password(password):
+    return PH.hash(password)
+
+def verify_password(stored_hash, password):
+    # Returns (matches, new_hash); new_hash is set when the stored hash should
+    # be upgraded, including old Werkzeug PBKDF2 hashes from before Argon2id.
+    if not stored_hash.startswith('$argon2'):
+        if check_password_hash(stored_hash, password):
+            return True, PH.hash(password)
+        return False, None
+    try:
+        PH.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False, None
+    return True, PH.hash(password) if PH.check_needs_rehash(stored_hash) else None
 
 # --- Database Functions ---
 
+# Long-lived connections shared across requests so each hit skips connect/close
+# and keeps SQLite's page cache warm.
+DB_POOL = queue.Queue(maxsize=DB_POOL_SIZE)
+
+# Applied once per physical connection: WAL lets readers run alongside the
+# /register writer, and synchronous=NORMAL drops the per-commit fsyncs.
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA foreign_keys=ON',
+)
+
+def connect_db():
+    db = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        db.execute(pragma)
+    return db
+
+def init_db_pool():
+    while not DB_POOL.full():
+        DB_POOL.put(connect_db())
+
 def get_db():
+    # Never blocks: an empty pool (not pre-warmed, or all connections checked
+    # out) just opens a fresh connection.
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        try:
+            g.db = DB_POOL.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        try:
+            DB_POOL.put_nowait(db)
+        except queue.Full:
+            db.close()
 
 def init_db():
-    with app.app_context():
-        db = get_db()
+    # Uses its own one-shot connection so it doesn't depend on the pool.
+    db = connect_db()
+    try:
         db.execute('DROP TABLE IF EXISTS users;')
         db.execute('''
             CREATE TABLE users (
@@ -55,19 +132,63 @@ def init_db():
                 address TEXT
             );
         ''')
-        db.commit()
+        db.execute('CREATE INDEX IF NOT EXISTS idx_users_uid ON users(uid);')
+    finally:
+        db.close()
     print("Initialized the database with the new schema including passwords.")
 
+INSERT_USER_SQL = '''
+    INSERT INTO users (uid, username, password, first_name, middle_name, last_name, age, gender, state, email, contact_number, address)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def insert_users(rows):
+    # Bulk import for admin/test scripts. Pooled connections autocommit, so
+    # the explicit BEGIN is what makes this one transaction (and one commit)
+    # for all rows instead of one per user.
+    db = connect_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(INSERT_USER_SQL, rows)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    finally:
+        db.close()
+
 # --- File and Directory Setup ---
 if not os.path.exists(USER_FILES_DIR):
     os.makedirs(USER_FILES_DIR)
 
+# Uploaded files follow the process umask, same as a plain open() would.
+_umask = os.umask(0)
+os.umask(_umask)
+UPLOAD_FILE_MODE = 0o666 & ~_umask
+
+# --- Upload Helpers ---
+class CompletedFileTarget(FileTarget):
+    # Records whether the parser reached the part's closing delimiter, so a
+    # truncated body never replaces a file in the user's folder.
+    finished = False
+
+    def on_finish(self):
+        super().on_finish()
+        self.finished = True
+
 # --- Helper function for path safety ---
+@functools.lru_cache(maxsize=1024)
+def _real_base(base_path):
+    return os.path.realpath(base_path)
+
 def get_safe_path(base_path, user_provided_path=""):
     if user_provided_path:
         user_provided_path = os.path.normpath(user_provided_path).lstrip('/')
     full_path = os.path.join(base_path, user_provided_path)
-    if os.path.commonprefix((os.path.realpath(full_path), os.path.realpath(base_path))) != os.path.realpath(base_path):
+    real_base = _real_base(base_path)
+    # commonpath compares whole components, so /a/bb is not inside /a/b.
+    if os.path.commonpath((os.path.realpath(full_path), real_base)) != real_base:
         raise ValueError("Attempted directory traversal.")
     return full_path
 
@@ -81,7 +202,7 @@ def index():
 def handle_user_scan(uid):
     with app.app_context():
         db = get_db()
-        user = db.execute('SELECT * FROM users WHERE uid = ?', (uid,)).fetchone()
+        user = db.execute('SELECT 1 FROM users WHERE uid = ? LIMIT 1', (uid,)).fetchone()
         target_url = url_for('register_page', uid=uid)
         if user:
             target_url = url_for('user_dashboard', uid=uid)
@@ -93,11 +214,16 @@ def handle_login():
     username = request.form['username']
     password = request.form['password']
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    user = db.execute('SELECT uid, password FROM users WHERE username = ? LIMIT 1', (username,)).fetchone()
 
-    if user and check_password_hash(user['password'], password):
-        dashboard_url = url_for('user_dashboard', uid=user['uid'])
-        return jsonify({'success': True, 'dashboard_url': dashboard_url})
+    if user:
+        matches, new_hash = HASH_POOL.submit(verify_password, user['password'], password).result()
+        if matches:
+            # Transparently migrate outdated hashes on a successful login.
+            if new_hash:
+                db.execute('UPDATE users SET password = ? WHERE uid = ?', (new_hash, user['uid']))
+            dashboard_url = url_for('user_dashboard', uid=user['uid'])
+            return jsonify({'success': True, 'dashboard_url': dashboard_url})
     
     return jsonify({'success': False, 'message': 'Invalid username or password.'})
 
@@ -123,15 +249,12 @@ def register_user():
     address = request.form['address']
 
     # Hash the password for secure storage
-    hashed_password = generate_password_hash(password)
+    hashed_password = HASH_POOL.submit(hash_password, password).result()
     
     db = get_db()
     try:
-        db.execute('''
-            INSERT INTO users (uid, username, password, first_name, middle_name, last_name, age, gender, state, email, contact_number, address)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (uid, username, hashed_password, first_name, middle_name, last_name, age, gender, state, email, contact_number, address))
-        db.commit()
+        # A single INSERT is atomic on its own in autocommit mode.
+        db.execute(INSERT_USER_SQL, (uid, username, hashed_password, first_name, middle_name, last_name, age, gender, state, email, contact_number, address))
     except sqlite3.IntegrityError:
         return jsonify({'success': False, 'message': 'Username already exists.'})
 
@@ -159,9 +282,18 @@ def user_dashboard(uid, path):
     if not os.path.exists(current_path) or not os.path.isdir(current_path):
         return "Path does not exist.", 404
 
-    items = os.listdir(current_path)
-    files = sorted([item for item in items if os.path.isfile(os.path.join(current_path, item))])
-    folders = sorted([item for item in items if os.path.isdir(os.path.join(current_path, item))])
+    # scandir carries the entry type from the directory read itself, so
+    # classifying entries doesn't cost a stat() per item.
+    files = []
+    folders = []
+    with os.scandir(current_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                folders.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    files.sort()
+    folders.sort()
 
     breadcrumbs = []
     if path:
@@ -179,20 +311,45 @@ def user_dashboard(uid, path):
 # Other routes remain the same
 @app.route('/upload/<uid>', methods=['POST'])
 def upload_file(uid):
-    current_path = request.form.get('current_path', '')
+    # Parse the multipart body straight off the socket so the file is written
+    # to disk once, instead of being buffered by Werkzeug's form parser first.
+    # It lands in a temp file on the same filesystem and is renamed into place
+    # once the filename and current_path are known.
+    if request.mimetype != 'multipart/form-data':
+        return "Invalid upload.", 400
     base_user_dir = os.path.join(app.config['USER_FILES_DIR'], uid)
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['USER_FILES_DIR'], prefix='.upload-')
+    os.close(fd)
     try:
-        upload_dir = get_safe_path(base_user_dir, current_path)
-    except ValueError:
-        return "Invalid path specified.", 400
-    if 'file' not in request.files:
-        return redirect(url_for('user_dashboard', uid=uid, path=current_path))
-    file = request.files['file']
-    if file.filename == '':
-        return redirect(url_for('user_dashboard', uid=uid, path=current_path))
-    if file:
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(upload_dir, filename))
+        path_target = ValueTarget()
+        file_target = CompletedFileTarget(tmp_path)
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register('current_path', path_target)
+            parser.register('file', file_target)
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.data_received(chunk)
+            current_path = path_target.value.decode('utf-8')
+        except (ParseFailedException, UnicodeDecodeError):
+            return "Invalid upload.", 400
+        try:
+            upload_dir = get_safe_path(base_user_dir, current_path)
+        except ValueError:
+            return "Invalid path specified.", 400
+        filename = secure_filename(file_target.multipart_filename or '')
+        if filename:
+            if not file_target.finished:
+                return "Incomplete upload.", 400
+            # mkstemp creates the file as 0600; give it the mode a normal
+            # write would have had before moving it into place.
+            os.chmod(tmp_path, UPLOAD_FILE_MODE)
+            os.replace(tmp_path, os.path.join(upload_dir, filename))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return redirect(url_for('user_dashboard', uid=uid, path=current_path))
 
 @app.route('/create_folder/<uid>', methods=['POST'])
@@ -232,7 +389,12 @@ def view_file(uid, filename):
         file_dir = os.path.dirname(filename)
         actual_filename = os.path.basename(filename)
         directory_to_serve = get_safe_path(base_user_dir, file_dir)
-        return send_from_directory(directory_to_serve, actual_filename)
+        response = send_from_directory(directory_to_serve, actual_filename)
+        # Per-user files: browsers may keep a copy but must revalidate it (the
+        # ETag turns repeat views into 304s); shared caches must not store it.
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
     except ValueError:
         return "Invalid path specified.", 400
 
@@ -250,4 +412,5 @@ def download_file(uid, filename):
 if __name__ == '__main__':
     if not os.path.exists(DATABASE):
         init_db()
+    init_db_pool()
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
@@ -1,15 +1,25 @@
+# eventlet must patch the standard library before anything else imports it.
+import eventlet
+eventlet.monkey_patch()
+
 import json
+import math
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, render_template, send_from_directory
 from flask_cors import CORS
 from flask_socketio import SocketIO
 import threading
 import time
+from eventlet import tpool
 import numpy as np
+from scipy.signal import firwin, upfirdn
 import speech_recognition as sr
 from gtts import gTTS
 import uuid
+import openwakeword
 from openwakeword.model import Model
 from openwakeword.utils import download_models
 import subprocess
@@ -20,24 +30,52 @@ warnings.filterwarnings("ignore")
 
 # Initialize the Flask application and SocketIO
 app = Flask(__name__, template_folder='templates', static_folder='static')
-socketio = SocketIO(app, async_mode='threading')
+socketio = SocketIO(app, async_mode='eventlet')
 
 # --- Configuration ---
 DEVICES_FILE = 'devices.json'
 OLLAMA_API_URL = "http://10.163.xx.xx:11434/api/generate"
 OLLAMA_MODEL = "mistral"
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_TOKENS_PER_ACTION = 48 # Generous token budget for one action (or one device entry) in JSON
+
+# Fixed instructions sent as Ollama's system prompt; only the device states
+# and command change per call, so the model can reuse the cached prefix.
+OLLAMA_SYSTEM_PROMPT = """
+You are a home assistant. Your task is to interpret a user's command and respond with a single JSON object.
+Each request gives the available devices with their current states, followed by the user's command.
+Your response MUST be a single JSON object with two keys: "actions" and "reply".
+- "reply": A friendly, conversational reply to the user.
+- "actions": A list of JSON objects, where each object represents a single device to control.
+  - Each object in the list must have: "action" ("turn_on" or "turn_off"), "device_ip", and "relay_index".
+  - If the command requires no action, the "actions" list should be empty.
+CRITICAL RULES:
+1.  If the user says "all", "everything", or a room name, you MUST generate an action for EACH relevant device.
+2.  Before generating an action, you MUST check the "currentState". Do not generate a "turn_on" action for a device that is already "on". Do not generate a "turn_off" action for a device that is already "off".
+3.  If all relevant devices are already in the requested state, the "actions" list must be empty, and your reply should inform the user.
+"""
 
 # Voice Assistant Configuration
 WAKEWORD_MODEL_NAME = "hey_jarvis"
+WAKEWORD_INT8_MODEL_PATH = "hey_jarvis_int8.onnx"
 COMMAND_SILENCE_THRESHOLD = 500
 COMMAND_SILENCE_DURATION = 1.5
 MAX_RECORDING_DURATION = 7
-CONFIDENCE_THRESHOLD = 0.5
+CONFIDENCE_THRESHOLD = 0.5 # Tuned on the FP32 model's scores; not yet re-checked against the INT8 model
+WAKEWORD_DEBOUNCE = 1.5 # Seconds after a reset during which wake triggers are ignored
+
+# Shared keep-alive HTTP session for talking to the relay boards, so repeat
+# polls and relay commands skip the TCP handshake.
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0))
+
+# Separate single-connection session for the LLM server.
+OLLAMA_SESSION = requests.Session()
+OLLAMA_SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
 
 # --- Global State Management ---
 device_states = {}
 app_state = "initializing" # For voice assistant status
-audio_chunks = []
 audio_lock = threading.Lock()
 
 # --- Audio Processing Class (from your script) ---
@@ -46,10 +84,34 @@ class AudioProcessor:
         self.audio = pyaudio.PyAudio()
         self.device_index = self._find_i2s_device()
         self.sample_rate, self.chunk_size = self._find_best_sample_rate()
-        self.oww_model = Model(wakeword_models=[WAKEWORD_MODEL_NAME], inference_framework='onnx')
+        wakeword_model_path = self._quantize_wakeword_model()
+        self.wakeword_key = os.path.splitext(os.path.basename(wakeword_model_path))[0]
+        self.oww_model = Model(wakeword_models=[wakeword_model_path], inference_framework='onnx')
         
         if not self.sample_rate:
             raise Exception("No compatible audio sample rate found!")
+
+        # Anti-aliasing FIR for the polyphase resampler, designed once here
+        # (the same design resample_poly uses, scaled by the upsampling gain).
+        ratio = math.gcd(self.sample_rate, 16000)
+        self._resample_up = 16000 // ratio
+        self._resample_down = self.sample_rate // ratio
+        max_rate = max(self._resample_up, self._resample_down)
+        self._resample_fir = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0)) * self._resample_up
+        # Input history carried between chunks so the filter never restarts from
+        # zero padding at a chunk boundary. It covers the filter length and is a
+        # multiple of the decimation factor, keeping the output phase aligned.
+        hist_len = -(-(len(self._resample_fir) - 1) // self._resample_up)
+        hist_len = -(-hist_len // self._resample_down) * self._resample_down
+        self._resample_hist = np.zeros(hist_len, dtype=np.float64)
+        self._resample_skip = hist_len * self._resample_up // self._resample_down
+
+        # Command audio is written straight into one preallocated buffer (with a
+        # chunk of slack for the frame that crosses MAX_RECORDING_DURATION).
+        self.rec_buf = np.empty(MAX_RECORDING_DURATION * self.sample_rate + self.chunk_size, dtype=np.int16)
+        self.rec_len = 0
+        self.last_wake_ts = 0.0
+        self.reset_pending = False
         
         print(f"✅ Audio system ready. Using {self.sample_rate}Hz with {self.chunk_size} sample chunks.")
 
@@ -64,6 +126,20 @@ class AudioProcessor:
         print("⚠️ Could not find I2S device, using default input.")
         return None
 
+    def _quantize_wakeword_model(self):
+        # Only the hey_jarvis classifier head is quantized to INT8 (converted
+        # once and cached); openWakeWord's melspectrogram and embedding models,
+        # which do most of the per-frame work, still run in FP32. The speedup
+        # has not been measured.
+        if not os.path.exists(WAKEWORD_INT8_MODEL_PATH):
+            # Imported here: quantization needs the onnx package, which
+            # openWakeWord itself doesn't, and it's only used on first start.
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            print("Quantizing wake word model to INT8...")
+            fp32_path = openwakeword.MODELS[WAKEWORD_MODEL_NAME]['model_path'].replace('.tflite', '.onnx')
+            quantize_dynamic(fp32_path, WAKEWORD_INT8_MODEL_PATH, weight_type=QuantType.QInt8)
+        return WAKEWORD_INT8_MODEL_PATH
+
     def _find_best_sample_rate(self):
         print("Finding optimal sample rate...")
         for rate in [48000, 44100, 32000, 22050, 16000]:
@@ -83,8 +159,12 @@ class AudioProcessor:
     def _resample_to_16k(self, audio_chunk):
         if self.sample_rate == 16000:
             return audio_chunk
-        factor = self.sample_rate // 16000
-        return audio_chunk[::factor]
+        extended = np.concatenate((self._resample_hist, audio_chunk))
+        self._resample_hist = extended[len(extended) - len(self._resample_hist):]
+        n_out = len(audio_chunk) * self._resample_up // self._resample_down
+        resampled = upfirdn(self._resample_fir, extended, self._resample_up, self._resample_down)
+        resampled = resampled[self._resample_skip:self._resample_skip + n_out]
+        return np.clip(resampled, -32768, 32767).astype(np.int16)
 
     def start_listening_loop(self):
         update_status("listening_for_wakeword", f"Listening for '{WAKEWORD_MODEL_NAME}'...")
@@ -95,10 +175,15 @@ class AudioProcessor:
         silent_frames = 0
         frames_per_second = int(self.sample_rate / self.chunk_size)
         recording_start_time = 0
+        # Silence check compares the squared L2 norm against the squared
+        # threshold; squares of int16 samples fit in int32, the sum needs int64.
+        silence_threshold_sq = COMMAND_SILENCE_THRESHOLD * COMMAND_SILENCE_THRESHOLD
+        energy_buf = np.empty(self.chunk_size, dtype=np.int32)
 
         while True:
-            # Always read from the stream to keep the buffer from overflowing
-            data = stream.read(self.chunk_size, exception_on_overflow=False)
+            # Always read from the stream to keep the buffer from overflowing.
+            # PyAudio blocks in C, so the read runs on eventlet's OS thread pool.
+            data = tpool.execute(stream.read, self.chunk_size, exception_on_overflow=False)
 
             # But only process the audio if we are in a listening state
             if app_state not in ["listening_for_wakeword", "recording_command"]:
@@ -108,28 +193,43 @@ class AudioProcessor:
             audio_chunk = np.frombuffer(data, dtype=np.int16)
 
             if app_state == "listening_for_wakeword":
+                # The model is only ever touched from this loop, so a reset
+                # requested by start_cooldown is applied here, between predictions.
+                if self.reset_pending:
+                    print("Resetting wake word model state...")
+                    self.oww_model.reset()
+                    self.last_wake_ts = time.monotonic()
+                    self.reset_pending = False
+
                 resampled_chunk = self._resample_to_16k(audio_chunk)
-                prediction = self.oww_model.predict(resampled_chunk)
+                prediction = tpool.execute(self.oww_model.predict, resampled_chunk)
                 
-                if prediction[WAKEWORD_MODEL_NAME] > CONFIDENCE_THRESHOLD:
+                if prediction[self.wakeword_key] > CONFIDENCE_THRESHOLD and \
+                   time.monotonic() - self.last_wake_ts >= WAKEWORD_DEBOUNCE:
                     print("Wake word detected!")
                     update_status("recording_command", "Listening for command...")
                     with audio_lock:
-                        audio_chunks.clear()
+                        self.rec_len = 0
                     silent_frames = 0
                     recording_start_time = time.time()
             
             elif app_state == "recording_command":
                 with audio_lock:
-                    audio_chunks.append(audio_chunk)
+                    # Clamp to the buffer: draining a PortAudio backlog can
+                    # deliver more than real-time worth of samples.
+                    n = min(len(audio_chunk), len(self.rec_buf) - self.rec_len)
+                    self.rec_buf[self.rec_len:self.rec_len + n] = audio_chunk[:n]
+                    self.rec_len += n
                 
-                if np.linalg.norm(audio_chunk) < COMMAND_SILENCE_THRESHOLD:
+                np.multiply(audio_chunk, audio_chunk, out=energy_buf, dtype=np.int32)
+                if energy_buf.sum(dtype=np.int64) < silence_threshold_sq:
                     silent_frames += 1
                 else:
                     silent_frames = 0
                 
                 if (silent_frames > COMMAND_SILENCE_DURATION * frames_per_second) or \
-                   (time.time() - recording_start_time > MAX_RECORDING_DURATION):
+                   (time.time() - recording_start_time > MAX_RECORDING_DURATION) or \
+                   (self.rec_len >= MAX_RECORDING_DURATION * self.sample_rate):
                     update_status("processing", "Processing your command...")
                     threading.Thread(target=process_recorded_command).start()
 
@@ -142,96 +242,101 @@ def update_status(new_state, message):
     socketio.emit('status_update', {'status': new_state, 'message': message})
 
 def process_recorded_command():
+    # The only copy of the utterance: raw PCM bytes straight from the buffer view.
     with audio_lock:
-        recorded_data = list(audio_chunks)
-        audio_chunks.clear()
+        pcm = audio_processor.rec_buf[:audio_processor.rec_len].tobytes()
+        audio_processor.rec_len = 0
 
-    if not recorded_data:
+    if not pcm:
         update_status("listening_for_wakeword", f"No command recorded. Listening...")
         return
-
-    full_recording = np.concatenate(recorded_data, axis=0)
     
     try:
         recognizer = sr.Recognizer()
-        audio_for_sr = sr.AudioData(full_recording.tobytes(), audio_processor.sample_rate, 2)
+        audio_for_sr = sr.AudioData(pcm, audio_processor.sample_rate, 2)
         transcribed_text = recognizer.recognize_google(audio_for_sr)
         print(f"Transcribed: {transcribed_text}")
         socketio.emit('new_message', {'sender': 'user', 'text': transcribed_text})
         
-        handle_ai_logic(transcribed_text)
+        handle_ai_logic(transcribed_text, from_voice=True)
 
     except Exception as e:
         print(f"Speech recognition failed: {e}")
         start_cooldown()
 
 def start_cooldown():
-    """Centralized function to handle cooldown and reset."""
-    def cooldown_thread():
-        update_status("cooldown", "Waiting before listening again...")
-        time.sleep(2.0) # Cooldown period
-        
-        print("Resetting wake word model state...")
-        audio_processor.oww_model.reset()
-        
-        update_status("listening_for_wakeword", f"Listening for '{WAKEWORD_MODEL_NAME}'...")
+    """Centralized function to reset the wake word model and resume listening."""
+    # No sleep here: the listening loop resets the model before its next
+    # prediction and ignores re-triggers for WAKEWORD_DEBOUNCE instead.
+    audio_processor.reset_pending = True
     
-    threading.Thread(target=cooldown_thread).start()
+    update_status("listening_for_wakeword", f"Listening for '{WAKEWORD_MODEL_NAME}'...")
 
 # --- Core Home Automation Logic (Integrated with Voice) ---
 
+# Parsed devices.json, reused until the file's mtime changes.
+_dev_cache = {'mtime': -1, 'data': {}}
+
 def read_devices():
-    if not os.path.exists(DEVICES_FILE): return {}
+    try:
+        mtime = os.stat(DEVICES_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime == _dev_cache['mtime']:
+        return _dev_cache['data']
     try:
         with open(DEVICES_FILE, 'r') as f:
             content = f.read()
-            if not content: return {}
-            return json.loads(content)
+            data = json.loads(content) if content else {}
     except (json.JSONDecodeError, IOError) as e:
         print(f"Error reading or parsing {DEVICES_FILE}: {e}")
         return {}
+    _dev_cache['mtime'] = mtime
+    _dev_cache['data'] = data
+    return data
 
 def write_devices(devices):
+    _dev_cache['mtime'] = -1
     with open(DEVICES_FILE, 'w') as f:
         json.dump(devices, f, indent=4)
+    _dev_cache['mtime'] = os.stat(DEVICES_FILE).st_mtime_ns
+    _dev_cache['data'] = devices
+
+def states_from_info(data):
+    return {str(status['relay']): status['state'] for status in data.get('status', [])}
 
 def update_state_for_device(ip):
     try:
-        response = requests.get(f'http://{ip}/info', timeout=2)
+        response = SESSION.get(f'http://{ip}/info', timeout=2)
         if response.status_code == 200:
-            data = response.json()
-            states = {}
-            for status in data.get('status', []):
-                states[str(status['relay'])] = status['state']
-            device_states[ip] = states
+            device_states[ip] = states_from_info(response.json())
     except requests.exceptions.RequestException:
         print(f"Could not poll device {ip} for status update.")
 
 def initialize_all_device_states():
     print("Initializing all device states...")
     devices = read_devices()
-    for ip in devices.keys():
-        update_state_for_device(ip)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(update_state_for_device, devices.keys()))
     print("Device state initialization complete.")
 
 def control_physical_relay(ip, relay_id, state):
     try:
         url = f'http://{ip}/relay/{relay_id}'
-        response = requests.post(url, params={'state': state}, timeout=3)
+        response = SESSION.post(url, params={'state': state}, timeout=3)
         response.raise_for_status()
-        if ip not in device_states: device_states[ip] = {}
-        device_states[ip][str(relay_id)] = state
+        device_states.setdefault(ip, {})[str(relay_id)] = state
         return True, response.text
     except requests.exceptions.RequestException as e:
         print(f"Error controlling relay {relay_id} on device {ip}: {e}")
         return False, str(e)
 
-def handle_ai_logic(user_message):
+def handle_ai_logic(user_message, from_voice=False):
     """Unified function to handle logic from both chat and voice."""
     devices = list(read_devices().values())
     if not devices:
         socketio.emit('new_message', {'sender': 'assistant', 'text': "No devices added yet."})
-        start_cooldown()
+        if from_voice: start_cooldown()
         return
 
     device_context = []
@@ -243,28 +348,32 @@ def handle_ai_logic(user_message):
         }
         device_context.append(info)
 
-    prompt = f"""
-You are a home assistant. Your task is to interpret a user's command and respond with a single JSON object.
-The available devices and their current states are:
-{json.dumps(device_context, indent=2)}
-The user's command is: "{user_message}"
-Your response MUST be a single JSON object with two keys: "actions" and "reply".
-- "reply": A friendly, conversational reply to the user.
-- "actions": A list of JSON objects, where each object represents a single device to control.
-  - Each object in the list must have: "action" ("turn_on" or "turn_off"), "device_ip", and "relay_index".
-  - If the command requires no action, the "actions" list should be empty.
-CRITICAL RULES:
-1.  If the user says "all", "everything", or a room name, you MUST generate an action for EACH relevant device.
-2.  Before generating an action, you MUST check the "currentState". Do not generate a "turn_on" action for a device that is already "on". Do not generate a "turn_off" action for a device that is already "off".
-3.  If all relevant devices are already in the requested state, the "actions" list must be empty, and your reply should inform the user.
+    prompt = f"""Devices: {json.dumps(device_context, separators=(',', ':'))}
+Command: "{user_message}"
 """
-    payload = {"model": OLLAMA_MODEL, "prompt": prompt, "format": "json", "stream": False}
+    # Generation cap grows with the relay count so "turn off everything" can
+    # list an action per relay without being cut off mid-JSON; the context
+    # window grows to fit the larger device list plus that output.
+    relay_count = sum(len(info["controls"]) for info in device_context)
+    num_predict = 256 + OLLAMA_TOKENS_PER_ACTION * relay_count
+    num_ctx = max(2048, -(-(1024 + num_predict + OLLAMA_TOKENS_PER_ACTION * relay_count) // 1024) * 1024)
+    payload = {
+        "model": OLLAMA_MODEL, "system": OLLAMA_SYSTEM_PROMPT, "prompt": prompt,
+        "format": "json", "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_ctx": num_ctx, "num_predict": num_predict},
+    }
 
     try:
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=30)
-        response.raise_for_status()
-        api_result = response.json()
-        ai_decision = json.loads(api_result.get("response", "{}"))
+        # Tokens are consumed as Ollama produces them; the reply is a single
+        # JSON object, so it is only parsed once the stream ends. The stream is
+        # read to EOF so the connection goes back to the pool instead of closing.
+        response_parts = []
+        with OLLAMA_SESSION.post(OLLAMA_API_URL, json=payload, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line: continue
+                response_parts.append(json.loads(line).get("response", ""))
+        ai_decision = json.loads("".join(response_parts) or "{}")
         
         actions_to_perform = ai_decision.get("actions", [])
         reply = ai_decision.get("reply", "I'm not sure how to respond.")
@@ -292,15 +401,25 @@ CRITICAL RULES:
             
             actions_to_perform = valid_actions
 
-        if actions_to_perform:
-            for action_item in actions_to_perform:
-                action = action_item.get("action")
-                device_ip = action_item.get("device_ip")
-                relay_index = action_item.get("relay_index")
-                if action in ["turn_on", "turn_off"] and device_ip and relay_index is not None:
-                    state = "on" if action == "turn_on" else "off"
-                    success, _ = control_physical_relay(device_ip, relay_index, state)
-                    if success: action_performed = True
+        relay_commands = {} # device_ip -> [(relay_index, state), ...]
+        for action_item in actions_to_perform:
+            action = action_item.get("action")
+            device_ip = action_item.get("device_ip")
+            relay_index = action_item.get("relay_index")
+            if action in ["turn_on", "turn_off"] and device_ip and relay_index is not None:
+                state = "on" if action == "turn_on" else "off"
+                relay_commands.setdefault(device_ip, []).append((relay_index, state))
+
+        if relay_commands:
+            # Devices are driven concurrently so multi-device commands land
+            # together; each board still gets its relays one request at a time.
+            def control_device_relays(device_ip):
+                return [control_physical_relay(device_ip, relay_index, state)[0]
+                        for relay_index, state in relay_commands[device_ip]]
+
+            with ThreadPoolExecutor(max_workers=min(8, len(relay_commands))) as executor:
+                results = list(executor.map(control_device_relays, relay_commands))
+            action_performed = any(any(device_results) for device_results in results)
         
         socketio.emit('new_message', {'sender': 'assistant', 'text': reply})
         if action_performed:
@@ -310,7 +429,8 @@ CRITICAL RULES:
         print(f"Error in AI logic: {e}")
         socketio.emit('new_message', {'sender': 'assistant', 'text': "Sorry, I had trouble processing that."})
     finally:
-        start_cooldown()
+        # Typed chat leaves the wake word pipeline alone.
+        if from_voice: start_cooldown()
 
 # --- Flask Routes and SocketIO Events ---
 
@@ -338,7 +458,7 @@ def add_device():
     devices = read_devices()
     if ip in devices: return jsonify({'error': 'Device with this IP already exists'}), 409
     try:
-        response = requests.get(f'http://{ip}/info', timeout=5)
+        response = SESSION.get(f'http://{ip}/info', timeout=5)
         response.raise_for_status()
         device_info = response.json()
         num_relays = device_info.get('numRelays', 0)
@@ -348,7 +468,8 @@ def add_device():
     new_device = {'name': data['name'], 'ip': ip, 'room': data['room'], 'numRelays': num_relays, 'relayNames': relay_names}
     devices[ip] = new_device
     write_devices(devices)
-    update_state_for_device(ip)
+    # The /info probe above already carries the relay states; no second poll.
+    device_states[ip] = states_from_info(device_info)
     return jsonify(new_device), 201
 
 
@@ -404,7 +525,7 @@ if __name__ == '__main__':
     
     initialize_all_device_states()
     audio_processor = AudioProcessor()
-    threading.Thread(target=audio_processor.start_listening_loop, daemon=True).start()
+    socketio.start_background_task(audio_processor.start_listening_loop)
     
     print("Starting Flask-SocketIO server...")
     socketio.run(app, host='0.0.0.0', port=5001)